@@ -25,6 +25,7 @@ interface StatusResponse {
   status: JobState;
   run_time: number;
   queue_time: number;
+  runId?: string | null;
 }
 
 //set API_BASE with your own modal username
@@ -50,8 +51,9 @@ const API = {
     return res.json();
   },
 
-  async pollStatus(documentId: string): Promise<StatusResponse> {
-    const res = await fetch(`${API_BASE}/poll?documentId=${documentId}`, { method: "GET" });
+  async pollStatus(documentId: string, runId: string | null): Promise<StatusResponse> {
+    const run = runId ? `&runId=${encodeURIComponent(runId)}` : "";
+    const res = await fetch(`${API_BASE}/poll?documentId=${documentId}${run}`, { method: "GET" });
     if (!res.ok) throw new Error(`Status failed (${res.status})`);
     return res.json();
   },
@@ -97,6 +99,7 @@ export default function FormPreparation() {
   const [keepExisting, setKeepExisting] = useState(false);
 
   const [state, setState] = useState<JobState | null>(null);
+  const [runId, setRunId] = useState<string | null>(null);
   const [error, setError] = useState<string | null>(null);
 
   const fileInputRef = useRef<HTMLInputElement | null>(null);
@@ -104,12 +107,18 @@ export default function FormPreparation() {
 
   // Poller - polls using documentId instead of jobId
   useEffect(() => {
-    if (!documentId || !state || state === "success" || state === "failure") return;
+    // wait for /detect to name the run, so a poll can't report the previous
+    // run's result for this document
+    if (!documentId || !runId || !state || state === "success" || state === "failure") return;
     let timer: ReturnType<typeof setInterval> | null = null;
+    let cancelled = false;
 
     const tick = async () => {
       try {
-        const res = await API.pollStatus(documentId);
+        const res = await API.pollStatus(documentId, runId);
+        // a reply for another run, or one that lands after a reset or
+        // re-run, says nothing about the run being shown
+        if (cancelled || (res.runId && res.runId !== runId)) return;
         setState(res.status);
         if (res.status === "success") {
           // Automatically trigger download when ready
@@ -119,6 +128,7 @@ export default function FormPreparation() {
           if (timer) clearInterval(timer);
         }
       } catch (e: any) {
+        if (cancelled) return;
         setState("failure");
         setError(e?.message ?? "Polling failed");
         if (timer) clearInterval(timer);
@@ -127,8 +137,8 @@ export default function FormPreparation() {
 
     tick();
     timer = setInterval(tick, POLL_MS);
-    return () => { if(timer) { clearInterval(timer) } };
-  }, [documentId, state]);
+    return () => { cancelled = true; if(timer) { clearInterval(timer) } };
+  }, [documentId, runId, state]);
 
   const onPickFile = () => fileInputRef.current?.click();
   const onFileChange: React.ChangeEventHandler<HTMLInputElement> = async (e) => {
@@ -153,6 +163,7 @@ export default function FormPreparation() {
   const onStart = async () => {
     if (!documentId) return;
     setError(null);
+    setRunId(null);
     setState("enqueued");
     try {
       const req: PrepareRequest = buildPrepareRequest(
@@ -163,6 +174,7 @@ export default function FormPreparation() {
         sensitivity,
       );
       const res = await API.startDetect(req);
+      setRunId(res.runId ?? null);
       setState(res.status);
     } catch (e: any) {
       setError(e?.message ?? "Failed to start job");
@@ -174,6 +186,7 @@ export default function FormPreparation() {
     setFile(null);
     setDocumentId(null);
     setState(null);
+    setRunId(null);
     setError(null);
   };
 
@@ -1,14 +1,21 @@
-from fastapi import FastAPI, UploadFile, HTTPException, File, status
-from fastapi.responses import FileResponse
+from fastapi import FastAPI, UploadFile, HTTPException, File, Header, status
+from fastapi.responses import FileResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from datetime import datetime, timedelta
+from collections import OrderedDict
+from dataclasses import asdict, dataclass
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import suppress
-from pydantic import BaseModel
-from typing import Literal
+from pydantic import BaseModel, Field
+from typing import Annotated, ClassVar, Literal, TypeVar
 from pathlib import Path
 from uuid import uuid4
+from grpclib import GRPCError
 
+import aiofiles
+import asyncio
+import hashlib
 import modal
 import time
 import os
@@ -18,56 +25,99 @@ import re
 
 
 MAX_BYTES = 100 * 1024 * 1024  # 100MB
-CHUNK_SIZE = 1 * 1024 * 1024  # 1MB
+MIN_CHUNK_SIZE = 64 * 1024  # 64KB
+
+# larger reads mean fewer event-loop round-trips per upload behind Modal's
+# proxy. clamped so a bad override can't turn every read into a zero-byte
+# "empty upload" (0) or a single read of the whole body (negative)
+CHUNK_SIZE = min(
+    max(int(os.environ.get("UPLOAD_CHUNK_SIZE", str(4 * 1024 * 1024))), MIN_CHUNK_SIZE),  # 4MB
+    MAX_BYTES,
+)
+
+
+PDF_HEADER = b"%PDF-"
+MAX_HEADER_OFFSET = 32
+WHITESPACE = frozenset(b" \t\n\r\x0b\x0c")
 
 
 def pdf_header_exists(chunk: bytes) -> bool:
-    i = chunk.lstrip().find(b"%PDF-")
-    return i == 0
+    # skip leading whitespace in place instead of lstrip(), which copies the
+    # whole buffer just to look at its first few bytes
+    i = 0
+    n = min(len(chunk), MAX_HEADER_OFFSET)
+    while i < n and chunk[i] in WHITESPACE:
+        i += 1
+    return chunk[i:i + len(PDF_HEADER)] == PDF_HEADER
 
 
-async def stream_save_pdf(
-    file: UploadFile, destination: Path
-) -> tuple[int, int | None]:
-    temp_path = destination.with_suffix(destination.suffix + ".part")
-    total = 0
-    header_buffer = bytearray()
+def advise(fd: int, advice: str) -> None:
+    """
+    Best-effort posix_fadvise over the whole file; a no-op on platforms (or
+    filesystems) without it.
+    """
+    if not hasattr(os, "posix_fadvise"):
+        return
+    with suppress(OSError):
+        os.posix_fadvise(fd, 0, 0, getattr(os, advice))
 
-    try:
-        out = open(temp_path, "wb", buffering=CHUNK_SIZE)
-        while chunk := await file.read(CHUNK_SIZE):
-            if len(header_buffer) < 5:
-                need = max(0, 1024 - len(header_buffer))
-                header_buffer.extend(chunk[:need])
 
-                if len(header_buffer) >= 5 and not pdf_header_exists(header_buffer):
-                    raise HTTPException(400)
+def drop_page_cache(path: str | Path) -> None:
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        advise(fd, "POSIX_FADV_DONTNEED")
+    finally:
+        os.close(fd)
 
-            total += len(chunk)
 
-            if total > MAX_BYTES:
-                raise HTTPException(400, "PDF exceeds 100 MB limit")
+async def stream_save_pdf(
+    file: UploadFile, destination: Path
+) -> tuple[int, str]:
+    total = 0
+    header_done = False
+    digest = hashlib.sha256()
 
-            out.write(chunk)
+    try:
+        # write straight to the final path (O_CREAT | O_EXCL) rather than
+        # spooling to a .part file and renaming, which on the volume mount
+        # costs a second full-file write plus a metadata flush
+        async with aiofiles.open(destination, "xb") as out:
+            advise(out.fileno(), "POSIX_FADV_SEQUENTIAL")
+            while chunk := await file.read(CHUNK_SIZE):
+                # the first read is a full chunk unless the upload is
+                # smaller than that, so the header is always in it
+                if not header_done:
+                    if not pdf_header_exists(chunk):
+                        raise HTTPException(400)
+                    header_done = True
+
+                total += len(chunk)
+
+                if total > MAX_BYTES:
+                    raise HTTPException(400, "PDF exceeds 100 MB limit")
+
+                digest.update(chunk)
+                await out.write(chunk)
 
         if total == 0:
             raise HTTPException(400, "Empty upload")
-        out.close()
-
-        os.replace(temp_path, destination)
 
     except Exception as e:
         with suppress(FileNotFoundError):
-            os.remove(temp_path)
+            os.unlink(destination)
         raise e
 
-    return total, None
+    return total, digest.hexdigest()
+
 
 
+# detection confidence threshold for each sensitivity level (1-5)
+SENSITIVITY_CONFIDENCE = (0.8, 0.5, 0.3, 0.1, 0.01)
+
 
 class PreparationConfig(BaseModel):
     model: Literal["small", "large"]
-    sensitivity: int
+    sensitivity: Annotated[int, Field(ge=1, le=len(SENSITIVITY_CONFIDENCE))]
     use_signature_fields: bool
     keep_existing_fields: bool
 
@@ -81,6 +131,7 @@ class StatusResponse(BaseModel):
     status: Literal["enqueued", "running", "success", "failure"]
     run_time: float
     queue_time: float
+    runId: str | None = None
 
 
 class DocumentResponse(BaseModel):
@@ -89,7 +140,178 @@ class DocumentResponse(BaseModel):
     size: int
 
 
+# Per-document state lives in the `requests` Dict under (document_id, KEY),
+# one sub-record per writer, so updates never read-modify-write the whole
+# job. Each detection run gets its own status key, (document_id, KEY, run),
+# and /detect alone moves the document's (document_id, "run") pointer, so a
+# worker can only ever write its own run. Timestamps are epoch floats and the
+# config is stored as JSON, so records pickle as plain primitives.
+
+
+@dataclass(slots=True)
+class JobMeta:
+    """
+    Written once by /upload.
+    """
+    KEY: ClassVar[str] = "meta"
+
+    original_filename: str
+    pages: int
+    sha256: str
+
+
+@dataclass(slots=True)
+class JobConfig:
+    """
+    Written by /detect for each detection run.
+    """
+    KEY: ClassVar[str] = "config"
+
+    config_json: str
+    filename: str
+
+
+@dataclass(slots=True)
+class JobStatus:
+    """
+    Written by /detect when a run is enqueued, then by that run's worker.
+    """
+    KEY: ClassVar[str] = "status"
+
+    status: str
+    enqueue_ts: float
+    output_key: str
+    output_path: str
+    run_ts: float | None = None
+    complete_ts: float | None = None
+    output_ready: bool = False
+
+
+JobPart = TypeVar("JobPart", JobMeta, JobConfig)
+
+
+def output_key(sha256: str, config_json: str) -> str:
+    """
+    Identifies a detection result: the same input bytes run with the same
+    config produce the same output, so the key is shared across uploads and
+    names the output file.
+    """
+    return hashlib.sha256(f"{sha256}:{config_json}".encode()).hexdigest()
+
+
+def output_path_for(key: str) -> Path:
+    return DATA_PATH / "outputs" / f"{key}.pdf"
+
+
+TERMINAL_STATUSES = ("success", "failure")
+TERMINAL_STATUS_TTL = 60.0  # seconds
+TERMINAL_STATUS_CACHE_SIZE = 1024
+
+# a finished run never changes, so repeated polls on it can skip the
+# modal.Dict round-trip. entries are keyed by (documentId, runId): a re-run
+# of the same document is a new run and can never be answered from here.
+terminal_status_cache: OrderedDict[tuple[str, str], tuple[float, StatusResponse]] = OrderedDict()
+
+
+def get_terminal_status(document_id: str, run: str) -> StatusResponse | None:
+    entry = terminal_status_cache.get((document_id, run))
+    if entry is None:
+        return None
+
+    cached_at, response = entry
+    if time.monotonic() - cached_at > TERMINAL_STATUS_TTL:
+        terminal_status_cache.pop((document_id, run), None)
+        return None
+
+    return response
+
+
+def put_terminal_status(document_id: str, run: str, response: StatusResponse) -> None:
+    terminal_status_cache[(document_id, run)] = (time.monotonic(), response)
+    terminal_status_cache.move_to_end((document_id, run))
+
+    while len(terminal_status_cache) > TERMINAL_STATUS_CACHE_SIZE:
+        terminal_status_cache.popitem(last=False)
+
+
+async def call_status(call_id: str) -> str | None:
+    """
+    Terminal status of a spawned `FormPreparer.prepare` call, or None if it's
+    still running (or its result has expired and the Dict is all we have).
+    """
+    call = modal.FunctionCall.from_id(call_id)
+    try:
+        return await call.get.aio(timeout=0)
+    except modal.exception.FunctionTimeoutError:
+        # the call hit its execution timeout; must come before the generic
+        # TimeoutError it subclasses, which just means "not done yet"
+        return "failure"
+    except (TimeoutError, modal.exception.TimeoutError):
+        # still running, or the result expired (OutputExpiredError)
+        return None
+    except (ConnectionError, modal.exception.ConnectionError, modal.exception.ClientClosed, GRPCError):
+        # couldn't reach Modal; that says nothing about the job itself
+        return None
+    except Exception:
+        # anything else was raised by the call: a crash, an internal
+        # failure, or an exception out of the function itself
+        return "failure"
+
+
+async def get_job(document_id: str, part: type[JobPart]) -> JobPart | None:
+    data = await requests.get.aio((document_id, part.KEY))
+    return None if data is None else part(**data)
+
+
+async def put_job(document_id: str, *parts: JobMeta | JobConfig) -> None:
+    await requests.update.aio({(document_id, part.KEY): asdict(part) for part in parts})
+
+
+def status_key(document_id: str, run: str) -> tuple[str, str, str]:
+    return (document_id, JobStatus.KEY, run)
+
+
+async def get_status(document_id: str, run: str | None = None) -> tuple[str, JobStatus] | None:
+    """
+    The status of one run of a document, defaulting to its latest run.
+    """
+    if run is None:
+        run = await requests.get.aio((document_id, "run"))
+        if run is None:
+            return None
+
+    data = await requests.get.aio(status_key(document_id, run))
+    return None if data is None else (run, JobStatus(**data))
+
+
+async def put_status(document_id: str, run: str, record: JobStatus) -> None:
+    await requests.put.aio(status_key(document_id, run), asdict(record))
+
+
+VOLUME_RELOAD_BACKOFF = (0.1, 0.25, 0.5, 1.0)  # seconds
+# re-running detection replaces the output behind the same URL, so clients
+# must revalidate every time; an unchanged output then costs only a 304
+DOWNLOAD_CACHE_CONTROL = "private, no-cache"
+
+def etag_matches(etag: str, if_none_match: str) -> bool:
+    """
+    If-None-Match uses weak comparison: `*` matches any current
+    representation, and a W/ prefix is ignored on either side.
+    """
+    if if_none_match.strip() == "*":
+        return True
+
+    def opaque(tag: str) -> str:
+        tag = tag.strip()
+        return tag[2:] if tag.startswith("W/") else tag
+
+    return opaque(etag) in {opaque(tag) for tag in if_none_match.split(",")}
+
+
+STALE_STATUS_AFTER = 30.0  # seconds
+
 DATA_PATH = Path("/data")
+INFERENCE_CPUS = 4
 
 image = (
     modal.Image.debian_slim(python_version="3.12")
@@ -99,9 +321,19 @@ image = (
         "fastapi[standard]",
         "python-multipart",
         "pydantic",
+        "aiofiles",
         "commonforms==0.1.4",
+        # matches uv.lock; later releases drop the `half` predict override
+        # that load_detector relies on for FP16
+        "ultralytics==8.3.204",
         gpu="T4"
     )
+    # rendering and YOLO pre/post-processing run on the CPU even with a GPU,
+    # and torch/OpenMP don't always pick up the container's CPU allocation
+    .env({
+        "OMP_NUM_THREADS": str(INFERENCE_CPUS),
+        "MKL_NUM_THREADS": str(INFERENCE_CPUS),
+    })
     .add_local_dir("./dist", "/root/dist")
 )
 app = modal.App(name="form-preparation", image=image)
@@ -111,51 +343,186 @@ requests = modal.Dict.from_name("form-preparation", create_if_missing=True)
 
 with image.imports():
     import formalpdf
-    from commonforms import prepare_form
+    import torch
+    from commonforms.form_creator import PyPdfFormCreator
+    from commonforms.inference import YOLODetector, render_pdf
+    from PIL import Image
+
+
+def count_pages(path: str | Path) -> int:
+    document = formalpdf.open(path)
+    try:
+        return len(document)
+    finally:
+        document.document.close()
 
 
 MODEL_MAP = {
     "large": "FFDNet-L",
     "small": "FFDNet-S",
 }
+DEVICE = "cuda"
+WARMUP_IMAGE_SIZE = 1600  # matches commonforms' default inference size
+PREPARE_BATCH_SIZE = 10
+PREPARE_BATCH_WAIT_MS = 250
+# documents in a batch run one after another, so the call's timeout has to
+# cover the whole batch rather than a single document
+PREPARE_DOCUMENT_TIMEOUT = 300  # seconds, Modal's default per call
+
+
+def load_detector(model: str) -> "YOLODetector":
+    detector = YOLODetector(MODEL_MAP[model], device=DEVICE)
+    # commonforms doesn't expose precision, but ultralytics merges the model's
+    # overrides into every predict() call; FP16 roughly doubles T4 throughput
+    detector.model.overrides["half"] = True
+    return detector
+
+
+def detect_fields(
+    detector: "YOLODetector",
+    input_path: str | Path,
+    output_path: str | Path,
+    *,
+    keep_existing_fields: bool,
+    use_signature_fields: bool,
+    confidence: float,
+) -> None:
+    """
+    Mirrors `commonforms.prepare_form`, but runs against an already-built
+    detector rather than loading the weights on every call.
+    """
+    pages = render_pdf(input_path)
+    results = detector.extract_widgets(pages, confidence=confidence)
+
+    writer = PyPdfFormCreator(input_path)
+    if not keep_existing_fields:
+        writer.clear_existing_fields()
+
+    for page_ix, widgets in results.items():
+        for i, widget in enumerate(widgets):
+            name = f"{widget.widget_type.lower()}_{widget.page}_{i}"
+
+            if widget.widget_type == "TextBox":
+                writer.add_text_box(name, page_ix, widget.bounding_box)
+            elif widget.widget_type == "ChoiceButton":
+                writer.add_checkbox(name, page_ix, widget.bounding_box)
+            elif widget.widget_type == "Signature":
+                if use_signature_fields:
+                    writer.add_signature(name, page_ix, widget.bounding_box)
+                else:
+                    writer.add_text_box(name, page_ix, widget.bounding_box)
+
+    writer.save(output_path)
+    writer.close()
+
+
+@app.cls(
+    volumes={str(DATA_PATH): volume},
+    gpu="T4",
+    cpu=float(INFERENCE_CPUS),
+    timeout=PREPARE_BATCH_SIZE * PREPARE_DOCUMENT_TIMEOUT,
+)
+class FormPreparer:
+    @modal.enter()
+    def load(self):
+        """
+        Load both FFDNet models once per container and run a dummy inference
+        through each, so requests don't pay weight loading or CUDA warmup.
+        """
+        torch.set_num_threads(INFERENCE_CPUS)
+
+        self.detectors = {model: load_detector(model) for model in MODEL_MAP}
+
+        blank = Image.new("RGB", (WARMUP_IMAGE_SIZE, WARMUP_IMAGE_SIZE), "white")
+        for model, detector in self.detectors.items():
+            detector.model.predict(blank, imgsz=WARMUP_IMAGE_SIZE, device=DEVICE, verbose=False)
+
+            # fail the container rather than silently serve FP32 if an
+            # ultralytics upgrade stops honouring the override again
+            if not detector.model.predictor.model.fp16:
+                raise RuntimeError(f"{MODEL_MAP[model]} did not load in FP16")
+
+    @modal.batched(max_batch_size=PREPARE_BATCH_SIZE, wait_ms=PREPARE_BATCH_WAIT_MS)
+    async def prepare(
+        self,
+        input_paths: list[str | Path],
+        output_paths: list[str | Path],
+        configs: list[PreparationConfig],
+        document_ids: list[str],
+        runs: list[str],
+        enqueue_timestamps: list[float],
+        output_keys: list[str],
+    ) -> list[str]:
+        """
+        Callers spawn one document at a time; Modal collects up to
+        PREPARE_BATCH_SIZE of them into a single call. Documents run one after
+        another against the preloaded detectors, and each is committed and
+        published as soon as it finishes, so nobody waits on the rest of the
+        batch.
+
+        Each run writes only its own status key, rebuilt from the spawn
+        arguments rather than read back, and its own output file, so a run
+        superseded by a re-run can't overwrite the newer run's state.
+        """
+        await volume.reload.aio()
+
+        statuses = []
+        for input_path, output_path, config, document_id, run, enqueue_ts, key in zip(
+            input_paths, output_paths, configs, document_ids, runs, enqueue_timestamps, output_keys
+        ):
+            record = JobStatus(
+                status="running",
+                enqueue_ts=enqueue_ts,
+                output_key=key,
+                output_path=str(output_path),
+                run_ts=time.time(),
+            )
 
-
-@app.function(volumes={str(DATA_PATH): volume}, gpu="T4")#cpu=4.0)
-def prepare_pdf(input_path: str | Path, output_path: str | Path, config: PreparationConfig, document_id: str):
-    volume.reload()
-
-    requests[document_id] |= {
-        "status": "running",
-        "run_time": datetime.now()
-    }
-
-    #subprocess.run(["nvidia-smi"])
-    print(config.sensitivity)
-    
-    sensitivity_confidence = [0.8, 0.5, 0.3, 0.1, 0.01]
-    conf = sensitivity_confidence[config.sensitivity-1]
-    print(conf)
-    
-    try:
-        prepare_form(
-            input_path,
-            output_path,
-            keep_existing_fields=config.keep_existing_fields,
-            use_signature_fields=config.use_signature_fields,
-            model_or_path=MODEL_MAP[config.model],
-            device = "cuda",
-            confidence = conf
-        )
-        volume.commit()
-        job_status = "success"
-    except Exception as e:
-        job_status = "failure"
-        raise e
-    finally:
-        requests[document_id] |= {
-            "complete_time": datetime.now(),
-            "status": job_status
-        }
+            # re-run with new settings since this was enqueued; the client
+            # has moved on to the newer run, so don't spend the GPU on this one
+            if await requests.get.aio((document_id, "run")) != run:
+                record.status = "failure"
+                record.complete_ts = record.run_ts
+                await put_status(document_id, run, record)
+                statuses.append("failure")
+                continue
+
+            await put_status(document_id, run, record)
+
+            # write under a per-run name and rename into place, so the output
+            # path only ever holds a complete file, even if two runs with
+            # the same key overlap or a worker dies mid-write
+            partial_path = f"{output_path}.{run}.part"
+            try:
+                await asyncio.to_thread(
+                    detect_fields,
+                    self.detectors[config.model],
+                    input_path,
+                    partial_path,
+                    keep_existing_fields=config.keep_existing_fields,
+                    use_signature_fields=config.use_signature_fields,
+                    confidence=SENSITIVITY_CONFIDENCE[config.sensitivity-1],
+                )
+                os.replace(partial_path, output_path)
+                # commit before publishing the success, so /download never
+                # sees a finished job whose output isn't on the volume yet
+                await volume.commit.aio()
+                job_status = "success"
+            except Exception as e:
+                # one bad PDF shouldn't fail the rest of the batch
+                print(f"Detection failed for {document_id}: {e!r}")
+                with suppress(FileNotFoundError):
+                    os.unlink(partial_path)
+                job_status = "failure"
+
+            record.complete_ts = time.time()
+            record.status = job_status
+            record.output_ready = job_status == "success"
+            await put_status(document_id, run, record)
+
+            statuses.append(job_status)
+
+        return statuses
 
 
 
@@ -189,34 +556,54 @@ def form_preparation():
         input_dir = DATA_PATH / "inputs"
         input_dir.mkdir(exist_ok=True, parents=True)
         input_path = input_dir / f"{document_id}.pdf"
-        size, _ = await stream_save_pdf(file, input_path)
+        size, sha256 = await stream_save_pdf(file, input_path)
 
-        document = formalpdf.open(input_path)
-        pages = len(document)
-        document.document.close()
+        # parsing the PDF is blocking and can take seconds on large files,
+        # so keep it off the event loop
+        pages = await asyncio.to_thread(count_pages, input_path)
 
         # Store the original filename for later use
         original_filename = file.filename or "document.pdf"
-        requests[document_id] = {
-            "original_filename": original_filename,
-        }
+        await put_job(document_id, JobMeta(original_filename=original_filename, pages=pages, sha256=sha256))
+
+        await volume.commit.aio()
 
-        volume.commit()
+        # detection reads the input on another container, so once it's
+        # committed there's no reason to keep its pages cached here
+        await asyncio.to_thread(drop_page_cache, input_path)
 
         return DocumentResponse(documentId=document_id, pages=pages, size=size)
 
+    async def reuse_output(output_path: Path) -> bool:
+        """
+        Outputs are named by their output key, so an earlier identical
+        detection (same bytes, same config) that's still on the volume can be
+        served as-is.
+        """
+        try:
+            # clear_pdfs goes by mtime, so make sure the reused output
+            # outlives this run rather than its original one
+            await asyncio.to_thread(os.utime, output_path)
+        except FileNotFoundError:
+            # never produced, not visible here yet, or removed by clear_pdfs
+            return False
+
+        await volume.commit.aio()
+        return True
+
     @web_app.post("/detect")
     async def detect(request: PrepareRequest) -> StatusResponse:
 
         input_path = DATA_PATH / "inputs" / f"{request.documentId}.pdf"
 
-        output_dir = DATA_PATH / "outputs"
-        output_dir.mkdir(exist_ok=True)
-        output_path = output_dir / f"{request.documentId}.pdf"
-
         # Get the original filename and create fillable version
-        job_info = requests.get(request.documentId, {})
-        original_filename = job_info.get("original_filename", "document.pdf")
+        meta = await get_job(request.documentId, JobMeta)
+        if meta is None:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=f"No document found for {request.documentId}",
+            )
+        original_filename = meta.original_filename
 
         # Replace .pdf with _fillable.pdf
         if original_filename.lower().endswith(".pdf"):
@@ -224,67 +611,152 @@ def form_preparation():
         else:
             fillable_filename = original_filename + "_fillable.pdf"
 
-        requests[request.documentId] |= {
-            "config": request.config,
-            "status": "enqueued",
-            "enqueue_time": datetime.now(),
-            "run_time": None,
-            "complete_time": None,
-            "filename": fillable_filename,
-        }
+        config = JobConfig(
+            config_json=request.config.model_dump_json(),
+            filename=fillable_filename,
+        )
+        key = output_key(meta.sha256, config.config_json)
+        output_path = output_path_for(key)
+        output_path.parent.mkdir(exist_ok=True)
+
+        run = uuid4().hex
+        job = JobStatus(
+            status="enqueued",
+            enqueue_ts=time.time(),
+            output_key=key,
+            output_path=str(output_path),
+        )
 
-        volume.reload()  # Ensure we have the latest PDF from upload
+        reused = await reuse_output(output_path)
+        if reused:
+            job.status = "success"
+            job.run_ts = job.complete_ts = job.enqueue_ts
+            job.output_ready = True
 
-        prepare_pdf.spawn(input_path, output_path, request.config, request.documentId)
+        # config, the run's status and the pointer to it go out as one write
+        await requests.update.aio({
+            (request.documentId, JobConfig.KEY): asdict(config),
+            status_key(request.documentId, run): asdict(job),
+            (request.documentId, "run"): run,
+        })
 
-        return StatusResponse(status="enqueued", queue_time=0.0, run_time=0.0)
+        if reused:
+            # the client picks up the success on its next poll
+            return StatusResponse(status="enqueued", queue_time=0.0, run_time=0.0, runId=run)
 
+        # no volume.reload() here: the worker reloads before reading the input
 
-    @web_app.get("/poll")
-    async def poll(documentId: str) -> StatusResponse:
-        job_status = requests.get(documentId, {})
+        call = await FormPreparer().prepare.spawn.aio(
+            input_path, output_path, request.config, request.documentId, run, job.enqueue_ts, key
+        )
+        # kept under the run's own key, so a poll can never consult another
+        # run's call
+        await requests.put.aio((request.documentId, "call", run), call.object_id)
 
-        if not job_status or "status" not in job_status:
-            # Document exists but detection hasn't started yet
-            return StatusResponse(status="enqueued", queue_time=0.0, run_time=0.0)
+        return StatusResponse(status="enqueued", queue_time=0.0, run_time=0.0, runId=run)
 
-        if job_status.get("status") in ["running", "success", "failure"]:
-            run_time = ((job_status.get("complete_time") or datetime.now()) - job_status.get("run_time")).total_seconds()
+
+    @web_app.get("/poll")
+    async def poll(documentId: str, runId: str | None = None) -> StatusResponse:
+        # a client that names the run it started is answered for exactly that
+        # run, straight from its status key (or the cache); without one, the
+        # latest run is looked up first
+        if runId is not None:
+            cached = get_terminal_status(documentId, runId)
+            if cached is not None:
+                return cached
+
+        found = await get_status(documentId, runId)
+
+        if found is None:
+            # Document exists but detection hasn't started yet, or the named
+            # run isn't one /detect has recorded
+            return StatusResponse(status="enqueued", queue_time=0.0, run_time=0.0, runId=runId)
+
+        run, job = found
+
+        now = time.time()
+
+        current_status = job.status
+        last_change = job.run_ts if job.run_ts is not None else job.enqueue_ts
+        if current_status not in TERMINAL_STATUSES and now - last_change > STALE_STATUS_AFTER:
+            # a worker that crashed or timed out never writes its terminal
+            # status, so once the record has gone quiet ask the scheduler
+            # whether the call is still alive
+            call_id = await requests.get.aio((documentId, "call", run))
+            if call_id is not None:
+                current_status = await call_status(call_id) or current_status
+
+        if current_status in ["running", "success", "failure"] and job.run_ts is not None:
+            run_time = (job.complete_ts or now) - job.run_ts
         else:
             run_time = 0.
 
-        queue_time = ((job_status.get("run_time") or datetime.now()) - (job_status.get("enqueue_time") or datetime.now())).total_seconds()
+        queue_time = (job.run_ts or now) - (job.enqueue_ts or now)
 
-        return StatusResponse(
-            status=job_status.get("status"),
+        response = StatusResponse(
+            status=current_status,
             queue_time=queue_time,
             run_time=run_time,
+            runId=run,
         )
 
+        if response.status in TERMINAL_STATUSES:
+            put_terminal_status(documentId, run, response)
+
+        return response
+
 
     @web_app.get("/download")
-    async def download(documentId: str) -> FileResponse:
-        job = requests.get(documentId)
-        if job is None:
+    async def download(
+        documentId: str, if_none_match: str | None = Header(default=None)
+    ) -> Response:
+        # the worker only sets this after committing the output to the
+        # volume, so there's no need to stat the volume to find out
+        found = await get_status(documentId)
+        job = found[1] if found is not None else None
+        if job is None or not job.output_ready:
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND,
-                detail=f"No document found for {documentId}",
+                detail=f"No prepared output for {documentId}",
             )
 
-        output_dir = DATA_PATH / "outputs"
-        output_path = output_dir / f"{documentId}.pdf"
+        # the output is fully determined by the input bytes and config, so
+        # the output key doubles as a strong ETag and repeat downloads can be
+        # answered without touching the volume
+        etag = f'"{job.output_key}"'
+        cache_headers = {"Cache-Control": DOWNLOAD_CACHE_CONTROL, "ETag": etag}
+        if if_none_match is not None and etag_matches(etag, if_none_match):
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=cache_headers)
 
+        output_path = Path(job.output_path)
+
+        # the output is committed, so one reload is enough to see it if this
+        # container's view of the volume predates the commit
         if not output_path.exists():
-            try:
-                volume.reload()
-            except RuntimeError:
-                time.sleep(2)
-                volume.reload()
+            # reload raises RuntimeError while files are open on this
+            # container, so back off without blocking the other requests
+            for delay in VOLUME_RELOAD_BACKOFF:
+                try:
+                    await volume.reload.aio()
+                    break
+                except RuntimeError:
+                    await asyncio.sleep(delay)
+            else:
+                await volume.reload.aio()
+
+            # still missing after a fresh view: clear_pdfs removed it
+            if not output_path.exists():
+                raise HTTPException(
+                    status_code=status.HTTP_404_NOT_FOUND,
+                    detail=f"Output for {documentId} has expired",
+                )
 
         return FileResponse(
             str(output_path),
             media_type="application/pdf",
-            filename=job["filename"],
+            filename=(await get_job(documentId, JobConfig)).filename,
+            headers=cache_headers,
         )
 
     # Mount built frontend at root
@@ -297,6 +769,16 @@ def form_preparation():
     return web_app
 
 
+CLEANUP_WORKERS = 16
+
+
+def unlink_if_old(entry: os.DirEntry, cutoff_ts: float) -> None:
+    with suppress(FileNotFoundError):
+        # Delete if last modification is older than cutoff
+        if entry.stat(follow_symlinks=False).st_mtime < cutoff_ts:
+            os.unlink(entry.path)
+
+
 @app.function(schedule=modal.Period(hours=1), volumes={str(DATA_PATH): volume})
 def clear_pdfs():
     """
@@ -304,15 +786,18 @@ def clear_pdfs():
     """
     cutoff_ts = (datetime.now() - timedelta(hours=1)).timestamp()
 
+    entries = []
     for folder in ("inputs", "outputs"):
         dir_path = DATA_PATH / folder
         if not dir_path.exists():
             continue
 
-        for pdf_path in dir_path.glob("*.pdf"):
-            with suppress(FileNotFoundError):
-                # Delete if last modification is older than cutoff
-                if pdf_path.stat().st_mtime < cutoff_ts:
-                    pdf_path.unlink()
+        with os.scandir(dir_path) as it:
+            # .part files are outputs a worker died while writing
+            entries.extend(e for e in it if e.name.endswith((".pdf", ".part")))
+
+    # each stat/unlink is a round-trip on the volume, so fan them out
+    with ThreadPoolExecutor(CLEANUP_WORKERS) as pool:
+        list(pool.map(lambda entry: unlink_if_old(entry, cutoff_ts), entries))
 
     volume.commit()